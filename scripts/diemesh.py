@@ -30,13 +30,29 @@ import argparse
 from os.path import join, isfile
 from tempfile import TemporaryDirectory
 import subprocess
+from scipy import ndimage
+from surfaces_fetus.slabs import (stream, parse_size,
+                                  SIX_CONNECTED, TWENTY_SIX_CONNECTED)
 
 
 def run(command_array):
     return subprocess.run(command_array, stdout=subprocess.DEVNULL)
 
 
-minccalc = ['minccalc', '-quiet', '-clobber', '-byte', '-unsigned', '-expr']
+def iz_border(labels, boundary):
+    """
+    dilated intermediate zone where it touches the outer label
+    """
+    iz = ndimage.binary_dilation(labels > 3.5, SIX_CONNECTED)
+    return (iz & (labels < boundary)).astype(np.uint8)
+
+
+def grow_border(pre, labels):
+    pre = ndimage.binary_dilation(pre > 0.5, TWENTY_SIX_CONNECTED)
+    pre = ndimage.binary_dilation(pre, SIX_CONNECTED)
+    # just in case, this shouldn't do anything but it would remove
+    # parts that cover the subplate zone
+    return (pre & ((labels < 2.5) | (labels > 3.5))).astype(np.uint8)
 
 
 if __name__ == '__main__':
@@ -65,6 +81,9 @@ if __name__ == '__main__':
     ap.add_argument('-invert', action='store_true',
                     help='Flip 0/1 to create a negative mask so that '
                     'the lateral surface is painted 0.')
+    ap.add_argument('-memory', metavar='size', type=parse_size,
+                    help='Memory budget for processing the volume in slabs, '
+                    'e.g. 512Mi (default: whole volume at once).')
     ap.add_argument('labels', metavar='labels.mnc', type=input_file,
                     help='Painted segmentation volume with labels 1-6')
     ap.add_argument('obj', metavar='surface.obj', type=input_file,
@@ -76,25 +95,19 @@ if __name__ == '__main__':
     
     with TemporaryDirectory() as tmpdir:
         labels = args.labels
-        iz = join(tmpdir, 'iz.mnc')
         pre = join(tmpdir, 'die.mnc')
         die = args.keep if args.keep else join(tmpdir, 'die_final.mnc')
-        run(minccalc + ['A[0]>3.5',  labels, iz])
-        run(['dilate_volume', iz, iz, '1', '6', '1'])
-
-        boundary = str(args.boundary + 0.5)
-        run(minccalc + ['A[0]>0.5&&A[1]<' + boundary, iz, labels, pre])
+        boundary = args.boundary + 0.5
+        stream([(labels, np.float32)], [(pre, np.uint8)],
+               lambda data: iz_border(data, boundary), halo=1, memory=args.memory)
         # max_connect is passed as the third argument to mincdefrag.
         # larger values can compensate detections that happen on the 
         # lateral surface that result from messy segmentation
         # "garbage in, garbage out." --Claude
         # if these values don't work for a brain, just do this all by hand
         run(['mincdefrag', pre, pre, '1', '1', '14'])
-        run(['dilate_volume', pre, pre, '1', '26', '1'])
-        run(['dilate_volume', pre, pre, '1', '6', '1'])
-        # just in case, this shouldn't do anything but it would remove
-        # parts that cover the subplate zone
-        run(minccalc + ['A[0]>0.5&&(A[1]<2.5||A[1]>3.5)', pre, labels, die])
+        stream([(pre, np.uint8), (labels, np.float32)], [(die, np.uint8)],
+               grow_border, halo=2, memory=args.memory)
         
         run(['volume_object_evaluate', '-linear', die, args.obj, args.output])
         
@@ -54,6 +54,7 @@ my $label = 0;
 my $age = 0;
 my $no_downsize = 0;
 my $save_chamfer = undef;
+my $memory = undef;
 
 my @options = (
   ['-label', 'integer', 1, \$label,
@@ -69,6 +70,8 @@ my @options = (
    "gestational age estimate in weeks."],
    ['-slow', 'const', 1, \$no_downsize,
    "Don't change number of polygons."],
+   ['-memory', 'string', 1, \$memory,
+   "Memory budget for volume processing, e.g. 512Mi (default: unlimited)."],
   );
 
 GetOptions( \@options, \@ARGV ) or exit 1;
@@ -314,18 +317,11 @@ sub simple_chamfer {
   &run( 'mincreshape', '-image_range', '0', '255', $wm_mask, $mask);
   &run( 'mincdefrag', $mask, $mask, 0, 6 );
   &run( 'mincdefrag', $mask, $mask, 1, 6 );
-  &run( 'mincchamfer', '-quiet', '-max_dist', '20.0',
-        $mask, "${tmpdir}/chamfer_outside.mnc" );
-  &run( 'minccalc', '-quiet', '-clobber', '-expression', '1-A[0]',
-        $mask, "${tmpdir}/wm_mask_negated.mnc" );
-  &run( 'mincchamfer', '-quiet', '-max_dist', '5.0',
-        "${tmpdir}/wm_mask_negated.mnc", "${tmpdir}/chamfer_inside.mnc" );
-  unlink( "${tmpdir}/wm_mask_negated.mnc" );
-  &run( 'minccalc', '-quiet', '-clob', '-expression', "10.0-A[0]+A[1]",
-        "${tmpdir}/chamfer_inside.mnc", "${tmpdir}/chamfer_outside.mnc",
-        $output_chamfer );
-  unlink( "${tmpdir}/chamfer_outside.mnc" );
-  unlink( "${tmpdir}/chamfer_inside.mnc" );
+  # 10.0-inside+outside, streamed in slabs
+  my @memory_opts = defined( $memory ) ? ( '-memory', $memory ) : ();
+  &run( 'volume_filter.py', @memory_opts, 'chamfer',
+        '-max_outside', '20.0', '-max_inside', '5.0',
+        $mask, $output_chamfer );
   return $output_chamfer;
 }
 
@@ -69,6 +69,8 @@ my $xfm = undef;
 my $label = 0;
 my $save_chamfer = undef;
 my $age = 20.0;
+my $cache_dir = undef;
+my $memory = undef;
 my @options = (
   ['-left', 'const', "Left", \$side, "Extract left surface"],
   ['-right', 'const', "Right", \$side, "Extract right surface"],
@@ -87,6 +89,10 @@ my @options = (
    . "\n6=ventricle."],
    ['-age', 'float', 1, \$age,
    "Prevent overfitting by increasing voxel size to match edge lengths."],
+   ['-cache', 'string', 1, \$cache_dir,
+   "Directory for reusing surface smoothing matrices between subjects."],
+   ['-memory', 'string', 1, \$memory,
+   "Memory budget for volume processing, e.g. 512Mi (default: unlimited)."],
    # ['-sw', 'float', 1, \$sw,
    # "ASP stretch weight regulates edge length and causes mesh shrinkage."],
    # ['-lw', 'float', 1, \$lw,
@@ -109,6 +115,7 @@ if( !( defined $side ) ) {
 
 
 my $tmpdir = &tempdir( "mcubes-XXXXXX", TMPDIR => 1, CLEANUP => 1 );
+my @memory_opts = defined( $memory ) ? ( '-memory', $memory ) : ();
 
 if ( $label > 0 ) {
   print "Creating a binary mask from the input segmentation.\n";
@@ -159,21 +166,7 @@ die "Empty white matter mask.\n" if( $sum == 0 );
 # Remove loosely connected voxels and fill-in tightly connected voxels
 # to have a smoother surface.
 
-open KRNL, "> ${tmpdir}/ngh_count.kernel";
-print KRNL "MNI Morphology Kernel File\n";
-print KRNL "Kernel_Type = Normal_Kernel;\n";
-print KRNL "Kernel =\n";
-print KRNL " 1.0  0.0  0.0  0.0  0.0  1.0\n";
-print KRNL "-1.0  0.0  0.0  0.0  0.0  1.0\n";
-print KRNL " 0.0  1.0  0.0  0.0  0.0  1.0\n";
-print KRNL " 0.0 -1.0  0.0  0.0  0.0  1.0\n";
-print KRNL " 0.0  0.0  1.0  0.0  0.0  1.0\n";
-print KRNL " 0.0  0.0 -1.0  0.0  0.0  1.0;\n";
-close KRNL;
-
-my $ngh_count = "${tmpdir}/ngh_count.mnc";
 my $white_matter_mask = "${tmpdir}/wm_mask_clean.mnc";
-my $tmp_wm_mask = "${tmpdir}/tmp_wm_mask.mnc";
 my $wm_mask_defragged = "${tmpdir}/wm_mask_defragged.mnc";
 
 &run( 'minccalc', '-quiet', '-clobber', '-unsigned', '-byte',
@@ -185,24 +178,11 @@ my $wm_mask_defragged = "${tmpdir}/wm_mask_defragged.mnc";
 # We will use a white matter mask with simplified connectivity
 # for the raw marching-cubes surface, but we will later fit the
 # surface to the original white matter mask.
-copy($wm_mask_defragged, $white_matter_mask);
-
-my $lower = 2.5;
 # May 29, 2019: changed 5 iterations down to 4
 # Aug 23, 2019: this made no sense before
-for( my $iter = 1; $iter <= 5; $iter++ ) {
-  my $ret = `mincstats -sum $white_matter_mask`; chomp( $ret );
-  print "Connectivity iteration $iter: $ret\n";
-  &run( 'mincmorph', '-clobber', '-unsigned', '-byte', '-convolve', '-kernel',
-        "${tmpdir}/ngh_count.kernel", $white_matter_mask, $ngh_count );
-  &run( 'minccalc', '-clob', '-quiet', '-expr',
-        "if(A[1]<$lower){0}else{if(A[1]>4.5){1}else{A[0]}}",
-        $white_matter_mask, $ngh_count, $tmp_wm_mask );
-  &run( 'mv', '-f', $tmp_wm_mask, $white_matter_mask );
-}
-
-unlink( $ngh_count );
-unlink( "${tmpdir}/ngh_count.kernel" );
+# Oct 19, 2026: 6-neighbour counting is done over z-slabs by volume_filter.py
+&run( 'volume_filter.py', @memory_opts, 'clean', '-iterations', 5,
+      $wm_mask_defragged, $white_matter_mask );
 
 # Preparation of the white matter mask for extraction of the surface
 # using marching cubes.
@@ -279,8 +259,18 @@ if( $side eq "Right" ) {
 
 # Evaluate the white surface from the marching-cubes surface.
 
-&resample_white_surface( $white_surface_sm, $white_sphere_sm,
-                         $unit_sphere, $white_surface, $xfm );
+# Resample the white surface from a standard sphere from the
+# hi-res marching-cubes white surface. The distribution of
+# vertices on the sphere is adapted such as to produce an
+# interpolated surface with triangles of nearly the same size.
+# Area ratios and smoothing are computed in-process by
+# resample_white_surface.py.
+
+my @resample_opts = ();
+push( @resample_opts, '-right' ) if( $side eq "Right" );
+push( @resample_opts, '-cache', $cache_dir ) if( defined( $cache_dir ) );
+&run( 'resample_white_surface.py', @resample_opts, $white_surface_sm,
+      $white_sphere_sm, $unit_sphere, $white_surface );
 
 # Do surface registration on to the average white population model.
 # This will be a first alignment that will ensure better isotropic mesh.
@@ -340,102 +330,6 @@ if( defined( $xfm ) && ( -e $xfm ) ) {
 &run_asp( $white_surface, $wm_mask_defragged, $initial_model );
 
 
-# Resample the white surface from a standard sphere from the
-# hi-res marching-cubes white surface. The distribution of
-# vertices on the sphere is adapted such as to produce an
-# interpolated surface with triangles of nearly the same size.
-
-sub resample_white_surface {
-
-  my $white_mc = shift;     # hi-res raw marching-cubes surface
-  my $sphere_mc = shift;    # sphere corresponding to white_mc
-  my $unit_sphere = shift;  # standard sphere
-  my $output = shift;       # output white surface with uniform triangles
-  my $xfm = shift;          # transform from native to stx space
-
-  my @conf = ( { 'size' => 320,     # most of the motion occurs early
-                 'fwhm' => 20.0,
-                 'niter' => 500 },
-               { 'size' => 1280,
-                 'fwhm' => 10.0,
-                 'niter' => 500 },
-               { 'size' => 5120,
-                 'fwhm' => 5.0,
-                 'niter' => 300 },
-               { 'size' => 20480,
-                 'fwhm' => 2.0,
-                 'niter' => 150 } );
-
-  my $start = 320;
-  my $end = 20480;
-
-  my $npolys = `print_n_polygons $unit_sphere`;
-  chomp( $npolys );
-
-  my $current_sphere = "${tmpdir}/current_sphere.obj";
-  &run( 'cp', '-f', $unit_sphere, $current_sphere );
-
-  # obtain initial white surface
-
-  &run( 'interpolate_sphere', $white_mc, $sphere_mc,
-        $current_sphere, $output );
-
-  # Multi-resolution approach from coarse to fine mesh.
-
-  for( my $idx = 0; $idx <= $#conf; $idx++ ) {
-
-    my $size = $conf[$idx]{size};
-
-    next if( $size < $start );
-    last if( $size > $end );
-
-    print "Sphere adaptation at $size vertices...\n";
-
-    # Obtain the triangle areas from current white surface to
-    # the current sphere at size npolys.
-
-    my $white_area = "${tmpdir}/white_area.txt";
-    my $sphere_area = "${tmpdir}/sphere_area.txt";
-    &run( 'depth_potential', '-area_simple', $output, $white_area );
-    &run( 'depth_potential', '-area_simple', $current_sphere, $sphere_area );
-    &run( 'vertstats_math', '-old_style_file', '-div', $white_area,
-          $sphere_area, $white_area );
-    unlink( $sphere_area );
-    if( $conf[$idx]{fwhm} > 0 ) {
-      &run( 'depth_potential', '-smooth', $conf[$idx]{fwhm},
-            $white_area, $output, $white_area );
-    }
-
-    # adapt the current_sphere at this size based on the areas.
-
-    &subdivide_mesh( $current_sphere, $size, $current_sphere );
-    &run( 'adapt_metric', $current_sphere, $white_area,
-          $current_sphere, $conf[$idx]{niter} );
-    unlink( $white_area );
-
-    # interpolate relative to the original white surface at npolys.
-
-    &subdivide_mesh( $current_sphere, $npolys, $current_sphere );
-    &run( 'interpolate_sphere', $white_mc, $sphere_mc,
-          $current_sphere, $output );
-
-  }
-
-  # Create a new hi-res background mesh with uniform triangles.
-  # This new background mesh will be used for interpolating the
-  # resampled white surface after surface registration. This way,
-  # we can associate the standard sphere to this new bg mesh
-  # since the standard sphere is used during surface registration.
-
-  $npolys *= 4;
-  &subdivide_mesh( $current_sphere, $npolys, $current_sphere );
-  &run( 'interpolate_sphere', $white_mc, $sphere_mc,
-        $current_sphere, $white_mc );
-  &subdivide_mesh( $unit_sphere, $npolys, $sphere_mc );
-  unlink( $current_sphere );
-
-}
-
 # Run ASP on the resampled white surface to converge it fully
 # to the white matter mask. This is a simplified version of
 # extract_white_surface without the coarse steps.
@@ -626,18 +520,11 @@ sub simple_chamfer {
   my $dist = shift;
   my $slope = shift;
   # expect white matter mask to have already been defragmented
-  &run( 'mincchamfer', '-quiet', '-max_dist', $dist,
-        $wm_mask, "${tmpdir}/chamfer_outside.mnc" );
-  &run( 'minccalc', '-quiet', '-clobber', '-expression', '1-A[0]',
-        $wm_mask, "${tmpdir}/wm_mask_negated.mnc" );
-  &run( 'mincchamfer', '-quiet', '-max_dist', $dist,
-        "${tmpdir}/wm_mask_negated.mnc", "${tmpdir}/chamfer_inside.mnc" );
-  unlink( "${tmpdir}/wm_mask_negated.mnc" );
-  &run( 'minccalc', '-quiet', '-clob', '-expression', "10.0+(A[1]-A[0])*$slope",
-        "${tmpdir}/chamfer_inside.mnc", "${tmpdir}/chamfer_outside.mnc",
-        $output_chamfer );
-  unlink( "${tmpdir}/chamfer_outside.mnc" );
-  unlink( "${tmpdir}/chamfer_inside.mnc" );
+  # 10.0+(outside-inside)*$slope, streamed in slabs since the mask
+  # may have been scaled up
+  &run( 'volume_filter.py', @memory_opts, 'chamfer',
+        '-max_outside', $dist, '-max_inside', $dist,
+        '-iso', 10.0, '-slope', $slope, $wm_mask, $output_chamfer );
   return $output_chamfer;
 }
 
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:37:52 2026
+
+Same as repair_sp.sh, but the morphology is done on the label array in
+one pass instead of through minccalc and dilate_volume. Many subjects
+can be patched in a single invocation.
+"""
+
+import argparse
+from os.path import isfile
+
+from surfaces_fetus.repair import repair_subplate_file
+from surfaces_fetus.slabs import parse_size
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Paints a one-voxel boundary of '
+                                 'value 3 inside the outer surface of the '
+                                 'intermediate zone where the subplate is '
+                                 'discontinuous.')
+    ap.add_argument('-k', metavar='mark.mnc', type=str, dest='marks',
+                    help='give a filename to keep the intermediate file '
+                    'which marks changed voxels. Only valid for one subject.')
+    ap.add_argument('-memory', metavar='size', type=parse_size,
+                    help='memory budget for processing volumes in slabs, '
+                    'e.g. 512Mi (default: whole volume at once)')
+    ap.add_argument('files', metavar='input_labels.mnc patched_labels.mnc',
+                    nargs='+',
+                    help='pairs of input and output filenames')
+    args = ap.parse_args()
+
+    if len(args.files) % 2 != 0:
+        ap.error('expected pairs of input and output filenames')
+    pairs = list(zip(args.files[0::2], args.files[1::2]))
+    if args.marks and len(pairs) > 1:
+        ap.error('-k can only be used with one subject')
+    for input_mnc, _ in pairs:
+        if not isfile(input_mnc):
+            ap.error(f'{input_mnc} does not exist.')
+
+    for input_mnc, output_mnc in pairs:
+        repair_subplate_file(input_mnc, output_mnc, args.marks, args.memory)
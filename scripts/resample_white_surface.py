@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:02:11 2026
+
+Resample the white surface from a standard sphere from the
+hi-res marching-cubes white surface. The distribution of
+vertices on the sphere is adapted such as to produce an
+interpolated surface with triangles of nearly the same size.
+
+Formerly the resample_white_surface subroutine of marching_cubes_fetus.pl.
+Vertex areas, their ratio and surface smoothing are computed in-process
+instead of with depth_potential and vertstats_math. Sphere-to-sphere
+interpolation reuses one spatial index over the marching-cubes sphere
+for every adaptation level instead of calling interpolate_sphere.
+"""
+
+import argparse
+import shutil
+import subprocess
+from os.path import isfile, join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from surfaces_fetus.mesh import read_obj, write_obj, area_ratio, heat_smooth
+from surfaces_fetus.sphere import SphereLocator
+
+
+CONF = (
+    # most of the motion occurs early
+    {'size': 320, 'fwhm': 20.0, 'niter': 500},
+    {'size': 1280, 'fwhm': 10.0, 'niter': 500},
+    {'size': 5120, 'fwhm': 5.0, 'niter': 300},
+    {'size': 20480, 'fwhm': 2.0, 'niter': 150},
+)
+
+
+def run(command_array):
+    return subprocess.run(command_array, stdout=subprocess.DEVNULL, check=True)
+
+
+def n_polygons(filename) -> int:
+    return int(subprocess.check_output(['print_n_polygons', filename]))
+
+
+def subdivide_mesh(input_obj, npoly, output_obj, flip, tmpdir):
+    """
+    subdivide a surface taking into account if it's a left or right hemisphere.
+    """
+    if n_polygons(input_obj) == npoly:
+        if input_obj != output_obj:
+            shutil.copy(input_obj, output_obj)
+        return
+    if not flip:
+        run(['subdivide_polygons', input_obj, output_obj, str(npoly)])
+        return
+    # flip right as left first before subdividing, then flip back.
+    flip_xfm = join(tmpdir, 'flip.xfm')
+    input_flipped = join(tmpdir, 'right_flipped.obj')
+    run(['param2xfm', '-clobber', '-scales', '-1', '1', '1', flip_xfm])
+    run(['transform_objects', input_obj, flip_xfm, input_flipped])
+    run(['subdivide_polygons', input_flipped, output_obj, str(npoly)])
+    # flip.xfm is its own inverse
+    run(['transform_objects', output_obj, flip_xfm, output_obj])
+
+
+def resample_white_surface(white_mc, sphere_mc, unit_sphere, output,
+                           flip=False, cache_dir=None):
+    """
+    :param white_mc: hi-res raw marching-cubes surface
+    :param sphere_mc: sphere corresponding to white_mc
+    :param unit_sphere: standard sphere
+    :param output: output white surface with uniform triangles
+    :param flip: unit_sphere was flipped for the right hemisphere
+    :param cache_dir: directory where smoothing operators are kept
+    """
+    with TemporaryDirectory() as tmpdir:
+        npolys = n_polygons(unit_sphere)
+        current_sphere = join(tmpdir, 'current_sphere.obj')
+        white_area = join(tmpdir, 'white_area.txt')
+        shutil.copy(unit_sphere, current_sphere)
+
+        # locate points on the marching-cubes sphere once for all levels
+        white_mc_points, _ = read_obj(white_mc)
+        locator = SphereLocator(*read_obj(sphere_mc))
+
+        def interpolate_sphere(sphere_obj, output_obj):
+            sphere_points, sphere_triangles = read_obj(sphere_obj)
+            points = locator.interpolate(white_mc_points, sphere_points)
+            write_obj(output_obj, points, sphere_triangles)
+            return sphere_points, points, sphere_triangles
+
+        # obtain initial white surface
+        sphere_points, white_points, triangles = interpolate_sphere(current_sphere, output)
+
+        # Multi-resolution approach from coarse to fine mesh.
+        for conf in CONF:
+            print(f'Sphere adaptation at {conf["size"]} vertices...')
+
+            # Obtain the triangle areas from current white surface to
+            # the current sphere at size npolys.
+            ratio = area_ratio(white_points, sphere_points, triangles)
+            ratio = heat_smooth(ratio, white_points, triangles, conf['fwhm'], cache_dir)
+            np.savetxt(white_area, ratio, fmt='%g')
+
+            # adapt the current_sphere at this size based on the areas.
+            subdivide_mesh(current_sphere, conf['size'], current_sphere, flip, tmpdir)
+            run(['adapt_metric', current_sphere, white_area,
+                 current_sphere, str(conf['niter'])])
+
+            # interpolate relative to the original white surface at npolys.
+            subdivide_mesh(current_sphere, npolys, current_sphere, flip, tmpdir)
+            sphere_points, white_points, triangles = interpolate_sphere(current_sphere, output)
+
+        # Create a new hi-res background mesh with uniform triangles.
+        # This new background mesh will be used for interpolating the
+        # resampled white surface after surface registration. This way,
+        # we can associate the standard sphere to this new bg mesh
+        # since the standard sphere is used during surface registration.
+        npolys *= 4
+        subdivide_mesh(current_sphere, npolys, current_sphere, flip, tmpdir)
+        interpolate_sphere(current_sphere, white_mc)
+        subdivide_mesh(unit_sphere, npolys, sphere_mc, flip, tmpdir)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Resample the marching-cubes '
+                                 'surface onto a standard sphere with '
+                                 'triangles of nearly the same size.')
+    def input_file(filename):
+        if isfile(filename):
+            return filename
+        else:
+            ap.error(f'Required input file "{filename}" does not exist.')
+    ap.add_argument('-right', action='store_true',
+                    help='unit sphere is flipped for the right hemisphere')
+    ap.add_argument('-cache', metavar='dir', type=str,
+                    help='directory for reusing smoothing matrices between runs')
+    ap.add_argument('white_mc', metavar='white_mc.obj', type=input_file,
+                    help='hi-res raw marching-cubes surface, '
+                    'replaced by the hi-res background mesh')
+    ap.add_argument('sphere_mc', metavar='sphere_mc.obj', type=input_file,
+                    help='sphere corresponding to white_mc.obj, '
+                    'replaced by the subdivided unit sphere')
+    ap.add_argument('unit_sphere', metavar='unit_sphere.obj', type=input_file,
+                    help='standard sphere')
+    ap.add_argument('output', metavar='white.obj', type=str,
+                    help='output white surface with uniform triangles')
+    args = ap.parse_args()
+    resample_white_surface(args.white_mc, args.sphere_mc, args.unit_sphere,
+                           args.output, args.right, args.cache)
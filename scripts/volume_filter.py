@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:48:05 2026
+
+Binary mask operations which stream the volume from disk in z-slabs,
+so that high-resolution segmentations can be processed within a fixed
+memory budget. Replacements for the mincmorph neighbour-count cleanup
+and mincchamfer distance maps.
+"""
+
+import argparse
+from os.path import isfile
+
+from surfaces_fetus.slabs import parse_size, clean_mask_volume, chamfer_volume
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Process a MINC volume in '
+                                 'z-slabs within a memory budget.')
+    def input_file(filename):
+        if isfile(filename):
+            return filename
+        else:
+            ap.error(f'Required input file "{filename}" does not exist.')
+    ap.add_argument('-memory', metavar='size', type=parse_size,
+                    help='memory budget which determines the slab size, '
+                    'e.g. 512Mi or 2Gi (default: whole volume at once)')
+    commands = ap.add_subparsers(dest='command')
+
+    clean = commands.add_parser('clean', help='remove loosely connected voxels '
+                                'and fill-in tightly connected voxels')
+    clean.add_argument('-iterations', type=int, default=5)
+
+    chamfer = commands.add_parser('chamfer', help='signed distance map '
+                                  'iso+(outside-inside)*slope around a mask')
+    chamfer.add_argument('-max_outside', type=float, default=10.0)
+    chamfer.add_argument('-max_inside', type=float, default=5.0)
+    chamfer.add_argument('-iso', type=float, default=10.0)
+    chamfer.add_argument('-slope', type=float, default=1.0)
+
+    for command in commands.choices.values():
+        command.add_argument('input', metavar='input.mnc', type=input_file)
+        command.add_argument('output', metavar='output.mnc', type=str)
+
+    args = ap.parse_args()
+    if args.command is None:
+        ap.error('missing command')
+
+    if args.command == 'clean':
+        clean_mask_volume(args.input, args.output, args.iterations, args.memory)
+    elif args.command == 'chamfer':
+        chamfer_volume(args.input, args.output, args.max_outside, args.max_inside,
+                       args.iso, args.slope, args.memory)
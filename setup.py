@@ -19,13 +19,14 @@ setup(
     url='https://fnndsc.childrens.harvard.edu/conferences/2020/OHBM/Jennings/'
         'Jennings_Zhang_OHBM_2020_Subplace_Surfaces.pdf',
     packages=['surfaces_fetus'],
-    install_requires=['chrisapp~=1.1.6', 'pybicpl==0.1-1'],
+    install_requires=['chrisapp~=1.1.6', 'pybicpl==0.1-1', 'numpy', 'scipy'],
     license='MIT',
     zip_safe=False,
     python_requires='>=3.6',
     entry_points={
         'console_scripts': [
-            'surfaces_fetus = surfaces_fetus.__main__:main'
+            'surfaces_fetus = surfaces_fetus.__main__:main',
+            'surfaces_fetus_cohort = surfaces_fetus.cohort:main'
         ]
     },
     scripts=glob('scripts/*')
@@ -0,0 +1,139 @@
+"""
+Content-addressed cache of pipeline results which persists across runs.
+
+Entries are directories named by a hash of everything which determines
+their contents (input data, parameters, software versions). Outputs are
+restored by hard-linking out of the cache, so a hit costs almost nothing.
+The least recently used entries are evicted when the cache exceeds its size.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+from os import path
+from tempfile import mkdtemp
+
+
+def hash_file(filename: str, chunk_size=1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(*parts) -> str:
+    """
+    Stable hash of JSON-serializable parts.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Attributes:
+        root (str): directory containing the cache entries
+        max_size (int): size in bytes above which old entries are evicted, None for no limit
+    """
+    def __init__(self, root: str, max_size: int = None):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    def _entry(self, key: str) -> str:
+        return path.join(self.root, key)
+
+    def fetch(self, key: str, outputs: dict) -> bool:
+        """
+        Restore the files of a cache entry.
+
+        :param key: from cache_key
+        :param outputs: mapping of names in the entry to destination file paths
+        :return: True if every output was restored
+        """
+        entry = self._entry(key)
+        if not all(path.isfile(path.join(entry, name)) for name in outputs):
+            return False
+        try:
+            for name, destination in outputs.items():
+                _link_or_copy(path.join(entry, name), destination)
+        except FileNotFoundError:
+            # evicted by a concurrent process while restoring, treat as a miss
+            return False
+        # mark as recently used
+        now = time.time()
+        try:
+            os.utime(entry, (now, now))
+        except FileNotFoundError:
+            # evicted by a concurrent process, files are already restored
+            pass
+        return True
+
+    def store(self, key: str, outputs: dict):
+        """
+        Copy files into a new cache entry, then evict old entries if needed.
+
+        :param key: from cache_key
+        :param outputs: mapping of names in the entry to the files to be stored
+        """
+        entry = self._entry(key)
+        if path.isdir(entry):
+            return
+        # write to a temporary directory first so that incomplete entries are never seen
+        tmp = mkdtemp(prefix='.tmp-', dir=self.root)
+        for name, source in outputs.items():
+            target = path.join(tmp, name)
+            shutil.copyfile(source, target)
+            # cached files are shared by hard links, they must never be modified
+            os.chmod(target, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process stored the same entry first
+            _remove(tmp)
+        self.evict()
+
+    def entries(self) -> list:
+        """
+        :return: list of (last used time, size in bytes, entry directory), least recent first
+        """
+        result = []
+        for name in os.listdir(self.root):
+            entry = path.join(self.root, name)
+            if name.startswith('.') or not path.isdir(entry):
+                continue
+            try:
+                size = sum(path.getsize(path.join(entry, f)) for f in os.listdir(entry))
+                result.append((path.getmtime(entry), size, entry))
+            except FileNotFoundError:
+                continue
+        return sorted(result)
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            _remove(entry)
+            total -= size
+
+
+def _link_or_copy(source: str, destination: str):
+    if path.lexists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # e.g. cache is on a different filesystem
+        shutil.copyfile(source, destination)
+
+
+def _remove(directory: str):
+    # files are read-only, but that does not prevent their removal
+    shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,278 @@
+"""
+Aggregate per-subject vertex-wise subplate thickness into a cohort matrix
+for vertex-wise quantitative analysis.
+
+A cohort is a directory containing:
+
+    thickness.f32   subjects x vertices float32 matrix, row-major, memory-mapped
+    mask.bits       subjects x vertices bitmask, each row packed into bytes,
+                    set bits are vertices included by not_subplate_mask.txt
+    index.csv       subject, age and side of every row
+    meta.json       number of vertices
+    cohort.lock     held while the cohort is being changed
+
+Subjects are appended one row at a time, so adding a subject does not depend
+on the size of the cohort. The index is written last, so rows of an
+interrupted append are ignored and overwritten by the next one.
+Adding the same subject and side again replaces its row. Changes are
+serialized by an exclusive lock, so subjects can be added by concurrent processes.
+"""
+
+import argparse
+import csv
+import fcntl
+import json
+import os
+import sys
+from contextlib import contextmanager
+from os import makedirs, path
+
+import numpy as np
+
+
+THICKNESS_FILE = 'thickness.f32'
+MASK_FILE = 'mask.bits'
+INDEX_FILE = 'index.csv'
+META_FILE = 'meta.json'
+LOCK_FILE = 'cohort.lock'
+INDEX_HEADER = ('subject', 'age', 'side')
+
+
+class Cohort:
+    """
+    Attributes:
+        root (str): cohort directory
+        n_vertices (int): number of vertices of every subject's surface
+        index (list): (subject, age, side) of every row
+    """
+    def __init__(self, root: str, n_vertices: int = None):
+        """
+        Open a cohort, creating it if it does not exist.
+
+        :param n_vertices: required to create a new cohort
+        """
+        self.root = root
+        meta_file = path.join(root, META_FILE)
+        if n_vertices is None and not path.isfile(meta_file):
+            raise ValueError(f'{root} is not a cohort')
+        makedirs(root, exist_ok=True)
+        with self._lock():
+            if path.isfile(meta_file):
+                with open(meta_file, 'r') as f:
+                    self.n_vertices = json.load(f)['n_vertices']
+                if n_vertices is not None and n_vertices != self.n_vertices:
+                    raise ValueError(f'cohort {root} has {self.n_vertices} vertices, not {n_vertices}')
+            else:
+                self.n_vertices = n_vertices
+                for name in (THICKNESS_FILE, MASK_FILE):
+                    open(path.join(root, name), 'wb').close()
+                self._write_index([])
+                with open(meta_file, 'w') as f:
+                    json.dump({'n_vertices': n_vertices}, f)
+            self._read_index()
+
+    @contextmanager
+    def _lock(self):
+        with open(path.join(self.root, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        with open(path.join(self.root, INDEX_FILE), 'r', newline='') as f:
+            rows = list(csv.reader(f))[1:]
+        self.index = [(subject, float(age), side) for subject, age, side in rows]
+
+    def _write_index(self, index: list):
+        # replace atomically, so that readers never see a partial index
+        index_file = path.join(self.root, INDEX_FILE)
+        tmp = index_file + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(INDEX_HEADER)
+            writer.writerows(index)
+        os.replace(tmp, index_file)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def mask_row_bytes(self) -> int:
+        return (self.n_vertices + 7) // 8
+
+    def append(self, subject: str, age: float, side: str, thickness: np.ndarray,
+               mask: np.ndarray = None):
+        """
+        Add a subject, or replace its row if it was already added for this side.
+
+        :param thickness: vertex-wise thickness of one subject
+        :param mask: boolean array of included vertices, default all vertices
+        """
+        thickness = np.asarray(thickness, dtype=np.float32)
+        if thickness.shape != (self.n_vertices,):
+            raise ValueError(f'expected {self.n_vertices} vertices, got {thickness.shape}')
+        if mask is None:
+            mask = np.ones(self.n_vertices, dtype=bool)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (self.n_vertices,):
+            raise ValueError(f'expected a mask of {self.n_vertices} vertices, got {mask.shape}')
+
+        with self._lock():
+            # other processes may have added subjects since the index was read
+            self._read_index()
+            rows = [i for i, (other, _, other_side) in enumerate(self.index)
+                    if other == subject and other_side == side]
+            if rows:
+                row = rows[0]
+                self._write_row(THICKNESS_FILE, row * self.n_vertices * 4, thickness.tobytes(), False)
+                self._write_row(MASK_FILE, row * self.mask_row_bytes, np.packbits(mask).tobytes(), False)
+                self.index[row] = (subject, float(age), side)
+                self._write_index(self.index)
+                return
+            n = len(self)
+            self._write_row(THICKNESS_FILE, n * self.n_vertices * 4, thickness.tobytes())
+            self._write_row(MASK_FILE, n * self.mask_row_bytes, np.packbits(mask).tobytes())
+            with open(path.join(self.root, INDEX_FILE), 'a', newline='') as f:
+                csv.writer(f).writerow((subject, age, side))
+            self.index.append((subject, float(age), side))
+
+    def _write_row(self, name: str, offset: int, data: bytes, last=True):
+        with open(path.join(self.root, name), 'r+b') as f:
+            if last:
+                # discard rows left behind by an interrupted append
+                f.truncate(offset)
+            f.seek(offset)
+            f.write(data)
+
+    def thickness(self) -> np.ndarray:
+        """
+        :return: read-only memory map of the subjects x vertices matrix
+        """
+        if len(self) == 0:
+            return np.empty((0, self.n_vertices), dtype=np.float32)
+        return np.memmap(path.join(self.root, THICKNESS_FILE), dtype=np.float32,
+                         mode='r', shape=(len(self), self.n_vertices))
+
+    def masks(self, start=0, stop=None) -> np.ndarray:
+        """
+        :return: boolean array of included vertices for rows start to stop
+        """
+        stop = len(self) if stop is None else stop
+        if stop <= start:
+            return np.empty((0, self.n_vertices), dtype=bool)
+        packed = np.memmap(path.join(self.root, MASK_FILE), dtype=np.uint8, mode='r',
+                           shape=(len(self), self.mask_row_bytes))
+        return np.unpackbits(packed[start:stop], axis=1)[:, :self.n_vertices].astype(bool)
+
+    def vertex_stats(self, bin_width=1.0, side: str = None, chunk_size=64) -> dict:
+        """
+        Streaming per-vertex mean and variance of thickness, by bins of
+        gestational age. Only chunk_size rows are in memory at once.
+        Masked vertices do not contribute.
+
+        :param bin_width: width of GA bins in weeks
+        :param side: only include subjects of this hemisphere
+        :return: mapping of the lower edge of each GA bin to
+                 a tuple of per-vertex (count, mean, variance) arrays
+        """
+        ages = np.array([age for _, age, _ in self.index])
+        bins = np.floor(ages / bin_width) * bin_width
+        selected = np.array([side is None or s == side for _, _, s in self.index], dtype=bool)
+        matrix = self.thickness()
+        stats = {}
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            values = np.asarray(matrix[start:stop], dtype=np.float64)
+            masks = self.masks(start, stop)
+            for b in np.unique(bins[start:stop][selected[start:stop]]):
+                rows = (bins[start:stop] == b) & selected[start:stop]
+                n, mean, m2 = _moments(values[rows], masks[rows])
+                stats[b] = _merge(stats[b], (n, mean, m2)) if b in stats else (n, mean, m2)
+        return {b: (n, mean, _variance(n, m2)) for b, (n, mean, m2) in sorted(stats.items())}
+
+
+def _moments(values: np.ndarray, masks: np.ndarray):
+    n = masks.sum(axis=0)
+    total = np.where(masks, values, 0).sum(axis=0)
+    mean = np.divide(total, n, out=np.zeros(values.shape[1]), where=n > 0)
+    m2 = (np.where(masks, values - mean, 0) ** 2).sum(axis=0)
+    return n, mean, m2
+
+
+def _merge(a, b):
+    """
+    Chan et al. parallel combination of counts, means and sums of squared deviations.
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    safe_n = np.maximum(n, 1)
+    mean = mean_a + delta * n_b / safe_n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / safe_n
+    return n, mean, m2
+
+
+def _variance(n: np.ndarray, m2: np.ndarray) -> np.ndarray:
+    """
+    Sample variance, NaN where there are fewer than two subjects.
+    """
+    return np.divide(m2, n - 1, out=np.full(m2.shape, np.nan), where=n > 1)
+
+
+def add_subject(cohort_dir: str, subject: str, age: float, side: str, result_dir: str):
+    """
+    Append the outputs of one run of this plugin to a cohort.
+    """
+    thickness = np.loadtxt(path.join(result_dir, 'sp_thickness_tlink.txt'), dtype=np.float32)
+    mask_txt = path.join(result_dir, 'qc', 'not_subplate_mask.txt')
+    mask = np.loadtxt(mask_txt, dtype=np.float32) > 0.5 if path.isfile(mask_txt) else None
+    Cohort(cohort_dir, len(thickness)).append(subject, age, side, thickness, mask)
+
+
+def write_stats(cohort_dir: str, output_dir: str, bin_width=1.0, side: str = None):
+    """
+    Write per-vertex count, mean and variance of each GA bin as text files.
+    """
+    makedirs(output_dir, exist_ok=True)
+    for b, (n, mean, var) in Cohort(cohort_dir).vertex_stats(bin_width, side).items():
+        prefix = path.join(output_dir, f'ga{b:g}-{b + bin_width:g}')
+        np.savetxt(prefix + '_n.txt', n, fmt='%d')
+        np.savetxt(prefix + '_mean.txt', mean, fmt='%f')
+        np.savetxt(prefix + '_var.txt', var, fmt='%f')
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Aggregate vertex-wise subplate thickness '
+                                 'of many subjects into a memory-mapped cohort matrix.')
+    commands = ap.add_subparsers(dest='command')
+
+    add = commands.add_parser('add', help='append the results of one subject')
+    add.add_argument('cohort', help='cohort directory, created if it does not exist')
+    add.add_argument('subject', help='subject identifier')
+    add.add_argument('age', type=float, help='gestational age in weeks')
+    add.add_argument('side', choices=('left', 'right'), help='brain hemisphere')
+    add.add_argument('results', help='output directory of surfaces_fetus for this subject')
+
+    stats = commands.add_parser('stats', help='per-vertex mean and variance by GA bin')
+    stats.add_argument('--bin-width', type=float, default=1.0,
+                       help='width of GA bins in weeks (default: 1)')
+    stats.add_argument('--side', choices=('left', 'right'),
+                       help='only include subjects of this hemisphere')
+    stats.add_argument('cohort', help='cohort directory')
+    stats.add_argument('output', help='directory for *_n.txt, *_mean.txt and *_var.txt')
+
+    args = ap.parse_args(argv)
+    if args.command == 'add':
+        add_subject(args.cohort, args.subject, args.age, args.side, args.results)
+    elif args.command == 'stats':
+        write_stats(args.cohort, args.output, args.bin_width, args.side)
+    else:
+        ap.print_usage()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
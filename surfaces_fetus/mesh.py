@@ -0,0 +1,182 @@
+"""
+Vectorized operations on MNI .obj triangle meshes.
+
+Replaces round-trips through text files with depth_potential and
+vertstats_math by computing vertex areas and surface smoothing
+directly on the mesh arrays.
+"""
+
+import hashlib
+import os
+from os import path
+from tempfile import mkstemp
+
+import numpy as np
+from scipy import sparse
+
+
+def read_obj(filename: str):
+    """
+    Parse a polygonal .obj file which contains only triangles.
+
+    :return: tuple of (points, triangles) as numpy arrays
+             of shapes (n_points, 3) and (n_triangles, 3)
+    """
+    with open(filename, 'r') as f:
+        data = f.read().split()
+    if data[0] != 'P':
+        raise ValueError('Only Polygons supported, ' + filename)
+
+    n_points = int(data[6])
+    start = 7
+    end = start + n_points * 3
+    points = np.array(data[start:end], dtype=np.float64).reshape(n_points, 3)
+
+    # skip over normals
+    end += n_points * 3
+    n_items = int(data[end])
+    if data[end + 1] != '0':
+        raise ValueError('colour_flag is not 0 in ' + filename)
+    # skip over colour_flag and RGBA
+    start = end + 6
+    end_indices = np.array(data[start:start + n_items], dtype=np.int64)
+    if not np.array_equal(end_indices, np.arange(3, n_items * 3 + 1, 3)):
+        raise ValueError('Found shape that is not a triangle in ' + filename)
+    start += n_items
+    triangles = np.array(data[start:start + n_items * 3], dtype=np.int64)
+    return points, triangles.reshape(n_items, 3)
+
+
+def write_obj(filename: str, points: np.ndarray, triangles: np.ndarray):
+    """
+    Write a triangle mesh in the same layout that the CIVET tools produce.
+    Normals are recomputed from the given points.
+    """
+    normals = vertex_normals(points, triangles)
+    n_items = len(triangles)
+    with open(filename, 'w') as out:
+        out.write('P 0.3 0.3 0.4 10 1 {}\n'.format(len(points)))
+        np.savetxt(out, points, fmt=' %.6g %.6g %.6g')
+        out.write('\n')
+        np.savetxt(out, normals, fmt=' %.6g %.6g %.6g')
+        out.write('\n {}\n 0 1 1 1 1\n\n'.format(n_items))
+        _write_rows(out, np.arange(3, n_items * 3 + 1, 3))
+        out.write('\n')
+        _write_rows(out, triangles.ravel())
+
+
+def _write_rows(out, values: np.ndarray, width=8):
+    for i in range(0, len(values), width):
+        out.write(' ' + ' '.join(str(v) for v in values[i:i + width]) + '\n')
+
+
+def triangle_areas(points: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    a, b, c = (points[triangles[:, i]] for i in range(3))
+    return 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1)
+
+
+def vertex_areas(points: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    """
+    Equivalent of depth_potential -area_simple: every vertex is given
+    one third of the area of each triangle it belongs to.
+    """
+    areas = triangle_areas(points, triangles) / 3
+    return np.bincount(triangles.ravel(), weights=np.repeat(areas, 3),
+                       minlength=len(points))
+
+
+def vertex_normals(points: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    a, b, c = (points[triangles[:, i]] for i in range(3))
+    face_normals = np.cross(b - a, c - a)
+    normals = np.zeros_like(points)
+    for i in range(3):
+        np.add.at(normals, triangles[:, i], face_normals)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0] = 1
+    return normals / lengths
+
+
+def area_ratio(white_points: np.ndarray, sphere_points: np.ndarray,
+               triangles: np.ndarray) -> np.ndarray:
+    """
+    Ratio of vertex areas between a surface and its sphere,
+    which both share the same connectivity.
+    """
+    return vertex_areas(white_points, triangles) / vertex_areas(sphere_points, triangles)
+
+
+def mean_edge_length(points: np.ndarray, triangles: np.ndarray) -> float:
+    edges = points[triangles] - points[np.roll(triangles, 1, axis=1)]
+    return float(np.mean(np.linalg.norm(edges, axis=2)))
+
+
+# Smoothing operators depend only on mesh connectivity, which is the same
+# for every surface resampled from a standard sphere of a given size.
+# Keep them around so that the adaptation levels of one resampling reuse them,
+# every subject is resampled by a new process so only cache_dir is shared.
+_smoothing_operators = {}
+
+
+def smoothing_operator(triangles: np.ndarray, n_points: int, cache_dir: str = None):
+    """
+    Lazy random-walk diffusion operator P = (D + I)^-1 (A + I)
+    over the vertex adjacency graph A with degrees D.
+
+    The operator is memoized by connectivity and, if cache_dir is given,
+    saved there so that later runs can load it instead of rebuilding.
+
+    :return: tuple of (P as a CSR matrix, mean vertex degree)
+    """
+    triangles = np.ascontiguousarray(triangles, dtype=np.int64)
+    key = hashlib.sha1(triangles.tobytes()).hexdigest()[:16]
+    key = '{}_{}'.format(len(triangles), key)
+    if key in _smoothing_operators:
+        return _smoothing_operators[key]
+
+    cached_file = path.join(cache_dir, f'smoothing_{key}.npz') if cache_dir else None
+    if cached_file and path.isfile(cached_file):
+        operator = sparse.load_npz(cached_file).tocsr()
+        degree = np.asarray(operator.getnnz(axis=1), dtype=np.float64) - 1
+    else:
+        rows = triangles[:, [0, 1, 2, 1, 2, 0]].ravel()
+        cols = triangles[:, [1, 2, 0, 0, 1, 2]].ravel()
+        adjacency = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)),
+                                      shape=(n_points, n_points)).tocsr()
+        # every edge is shared by two triangles
+        adjacency.data[:] = 1
+        degree = np.asarray(adjacency.sum(axis=1)).ravel()
+        operator = sparse.diags(1 / (degree + 1)) @ (adjacency + sparse.identity(n_points))
+        operator = operator.tocsr()
+        if cached_file:
+            # other processes, e.g. the opposite hemisphere, may be reading the cache
+            fd, tmp = mkstemp(suffix='.npz', dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                sparse.save_npz(f, operator)
+            os.replace(tmp, cached_file)
+
+    _smoothing_operators[key] = (operator, float(np.mean(degree)))
+    return _smoothing_operators[key]
+
+
+def heat_smooth(data: np.ndarray, points: np.ndarray, triangles: np.ndarray,
+                fwhm: float, cache_dir: str = None) -> np.ndarray:
+    """
+    Approximate depth_potential -smooth: diffuse vertex data over the surface
+    until the kernel reaches the given full width at half maximum (mm).
+
+    Each application of the diffusion operator moves the data a random-walk
+    step of one edge length, so the number of steps is chosen such that the
+    accumulated variance matches the variance of the Gaussian kernel.
+    """
+    if fwhm <= 0:
+        return data
+    operator, degree = smoothing_operator(triangles, len(points), cache_dir)
+    sigma2 = (fwhm / (2 * np.sqrt(2 * np.log(2)))) ** 2
+    h = mean_edge_length(points, triangles)
+    # per-axis variance of one lazy random-walk step on a 2D surface
+    step_variance = h ** 2 / 2 * degree / (degree + 1)
+    n_steps = max(1, int(round(sigma2 / step_variance)))
+    result = np.asarray(data, dtype=np.float64)
+    for _ in range(n_steps):
+        result = operator @ result
+    return result
@@ -0,0 +1,218 @@
+"""
+Read and write MINC volumes as numpy arrays.
+
+Voxel data is streamed through mincextract and rawtominc, so that this works
+with whichever MINC1/MINC2 libraries the CIVET tools were built against.
+Arrays are always in (z, y, x) order, regardless of the file's dimension order.
+"""
+
+import subprocess as sp
+
+import numpy as np
+
+
+SPATIAL_DIMS = ('zspace', 'yspace', 'xspace')
+DEFAULT_DIRCOS = {'xspace': (1.0, 0.0, 0.0), 'yspace': (0.0, 1.0, 0.0), 'zspace': (0.0, 0.0, 1.0)}
+
+# arguments for mincextract and rawtominc per numpy data type
+_TYPE_ARGS = {
+    np.dtype(np.uint8): ['-byte', '-unsigned'],
+    np.dtype(np.int16): ['-short', '-signed'],
+    np.dtype(np.float32): ['-float'],
+}
+
+
+def _type_dtype(dtype) -> np.dtype:
+    dtype = np.dtype(dtype)
+    if dtype not in _TYPE_ARGS:
+        raise ValueError(f'unsupported data type for MINC volumes: {dtype}')
+    return dtype
+
+
+def _type_args(dtype) -> list:
+    return _TYPE_ARGS[_type_dtype(dtype)]
+
+
+class MincHeader:
+    """
+    Spatial information of a 3D MINC volume.
+
+    Attributes:
+        dimnames (tuple): dimension order of the image variable in the file
+        shape (tuple): lengths in (z, y, x) order
+        step (dict): voxel separation for each of xspace, yspace, zspace
+        start (dict): world coordinate of the first voxel for each dimension
+        dircos (dict): direction cosines for each dimension, if present
+    """
+    def __init__(self, filename: str):
+        self.dimnames = tuple(_mincinfo(filename, '-vardims', 'image')[0].split())
+        if sorted(self.dimnames) != sorted(SPATIAL_DIMS):
+            raise ValueError(f'{filename} is not a 3D volume, dimensions are {self.dimnames}')
+        args = []
+        for dim in SPATIAL_DIMS:
+            args += ['-dimlength', dim,
+                     '-attvalue', f'{dim}:step',
+                     '-attvalue', f'{dim}:start',
+                     '-attvalue', f'{dim}:direction_cosines']
+        values = iter(_mincinfo(filename, *args))
+        lengths = []
+        self.step = {}
+        self.start = {}
+        self.dircos = {}
+        for dim in SPATIAL_DIMS:
+            lengths.append(int(next(values)))
+            self.step[dim] = float(next(values))
+            self.start[dim] = float(next(values))
+            dircos = next(values).split()
+            if len(dircos) == 3:
+                self.dircos[dim] = [float(c) for c in dircos]
+        self.shape = tuple(lengths)
+
+    @property
+    def transpose(self) -> tuple:
+        """
+        Axes permutation from file order to (z, y, x).
+        """
+        return tuple(self.dimnames.index(dim) for dim in SPATIAL_DIMS)
+
+    @property
+    def file_shape(self) -> tuple:
+        return tuple(self.shape[SPATIAL_DIMS.index(dim)] for dim in self.dimnames)
+
+    def world_coordinate(self, axis: int, z_start=0, z_count=None) -> tuple:
+        """
+        World coordinate of every voxel of a range of z-slices, as the sum of
+        a term per slice and a term over the (y, x) plane, so that the coordinate
+        never needs to be stored for every voxel.
+
+        :param axis: 0 for x, 1 for y, 2 for z
+        :return: tuple of arrays of shapes (z_count, 1, 1) and (1, ny, nx)
+        """
+        if z_count is None:
+            z_count = self.shape[0] - z_start
+        ranges = (np.arange(z_start, z_start + z_count), np.arange(self.shape[1]),
+                  np.arange(self.shape[2]))
+        terms = []
+        for i, (dim, indices) in enumerate(zip(SPATIAL_DIMS, ranges)):
+            # without direction cosines, dimensions are aligned with world axes
+            dircos = self.dircos.get(dim, DEFAULT_DIRCOS[dim])
+            index_shape = [1, 1, 1]
+            index_shape[i] = -1
+            world = (self.start[dim] + indices * self.step[dim]) * dircos[axis]
+            terms.append(world.reshape(index_shape))
+        z_term, y_term, x_term = terms
+        return z_term, y_term + x_term
+
+    def rawtominc_args(self) -> list:
+        args = []
+        for dim in SPATIAL_DIMS:
+            axis = dim[0]
+            args += [f'-{axis}step', str(self.step[dim]),
+                     f'-{axis}start', str(self.start[dim])]
+            if dim in self.dircos:
+                args += [f'-{axis}dircos'] + [str(c) for c in self.dircos[dim]]
+        return args
+
+
+def _mincinfo(filename: str, *args) -> list:
+    result = sp.run(['mincinfo', '-error_string', '', *args, filename],
+                    stdout=sp.PIPE, check=True, universal_newlines=True)
+    return result.stdout.split('\n')
+
+
+def read_volume(filename: str, dtype=np.float32, header: MincHeader = None):
+    """
+    :param filename: input.mnc
+    :param dtype: one of uint8, int16 or float32. Values are real values, i.e.
+                  voxel values scaled by the image range, rounded for integer types
+                  so that uint8 is appropriate for painted labels.
+    :param header: header of filename if it was already read
+    :return: tuple of (voxel data in (z, y, x) order, header)
+    """
+    if header is None:
+        header = MincHeader(filename)
+    data = read_hyperslab(filename, header, dtype)
+    return data, header
+
+
+def read_hyperslab(filename: str, header: MincHeader, dtype=np.float32,
+                   z_start=0, z_count=None) -> np.ndarray:
+    """
+    Read a range of z-slices from a volume.
+
+    :return: array of shape (z_count, ny, nx)
+    """
+    if z_count is None:
+        z_count = header.shape[0] - z_start
+    start = []
+    count = []
+    for dim, length in zip(header.dimnames, header.file_shape):
+        start.append(z_start if dim == 'zspace' else 0)
+        count.append(z_count if dim == 'zspace' else length)
+    # stored voxel values may be scaled to a real range by image-min/image-max,
+    # so always extract real values and round them for integer types
+    cmd = ['mincextract', '-float', '-normalize',
+           '-start', ','.join(map(str, start)), '-count', ','.join(map(str, count)),
+           filename]
+    raw = sp.run(cmd, stdout=sp.PIPE, check=True).stdout
+    real = np.frombuffer(raw, dtype=np.float32).reshape(count).transpose(header.transpose)
+    data = np.empty(real.shape, dtype=_type_dtype(dtype))
+    if data.dtype == np.float32:
+        data[...] = real
+    else:
+        np.rint(real, out=data, casting='unsafe')
+    return data
+
+
+class VolumeWriter:
+    """
+    Writes z-slices of a volume in order to a rawtominc process,
+    so that the whole volume never needs to be in memory at once.
+
+    Use as a context manager, the file is complete when the block exits.
+    """
+    def __init__(self, filename: str, header: MincHeader, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self._remaining = header.shape[0]
+        type_args = list(_type_args(dtype))
+        if self.dtype == np.uint8:
+            type_args += ['-range', '0', '255', '-real_range', '0', '255']
+        else:
+            type_args += ['-scan_range']
+        cmd = ['rawtominc', '-clobber', '-transverse', *type_args,
+               *header.rawtominc_args(), filename, *map(str, header.shape)]
+        self._process = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.DEVNULL)
+
+    def write(self, slab: np.ndarray):
+        """
+        :param slab: next z-slices in (z, y, x) order
+        """
+        self._remaining -= len(slab)
+        if self._remaining < 0:
+            raise ValueError('wrote more slices than the volume has')
+        raw = np.ascontiguousarray(slab, dtype=self.dtype)
+        self._process.stdin.write(raw.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._process.stdin.close()
+        code = self._process.wait()
+        if exc_type is None:
+            if self._remaining != 0:
+                raise ValueError(f'{self._remaining} slices were never written')
+            if code != 0:
+                raise sp.CalledProcessError(code, self._process.args)
+
+
+def write_volume(filename: str, data: np.ndarray, header: MincHeader, dtype=None):
+    """
+    :param data: voxel data in (z, y, x) order
+    :param header: spatial information, usually from the input volume
+    :param dtype: data type to write, default is the type of data
+    """
+    if tuple(data.shape) != tuple(header.shape):
+        raise ValueError(f'data shape {data.shape} does not match volume {header.shape}')
+    with VolumeWriter(filename, header, data.dtype if dtype is None else dtype) as writer:
+        writer.write(data)
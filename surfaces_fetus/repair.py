@@ -0,0 +1,51 @@
+"""
+Patch discontinuous subplate in painted labels, the in-process equivalent of repair_sp.sh.
+
+Paints a one-voxel boundary of value 3 inside the outer surface
+of the intermediate zone where the subplate is discontinuous,
+connecting the subplate over the hippocampus and fixing errors
+on the lateral surface while artificially connecting it over
+the diencephalonic region.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+from .slabs import stream, SIX_CONNECTED
+
+
+def repair_subplate(labels: np.ndarray):
+    """
+    :param labels: painted labels volume
+    :return: tuple of (patched labels, boolean array marking changed voxels)
+    """
+    # dilate sp region inwards into the iz
+    sp_grow = ndimage.binary_dilation(labels == 3, SIX_CONNECTED)
+    # like dilate_volume, voxels outside the volume do not erode the iz
+    iz_shrink = ndimage.binary_erosion(labels > 3, SIX_CONNECTED, border_value=1)
+    marks = (labels == 4) & ~sp_grow & ~iz_shrink
+    patched = labels.copy()
+    patched[marks] = 3
+    return patched, marks
+
+
+def repair_subplate_file(input_mnc: str, output_mnc: str, marks_mnc: str = None,
+                         memory: int = None):
+    """
+    Read painted labels, patch the subplate and write the result.
+
+    :param input_mnc: painted labels volume
+    :param output_mnc: patched labels volume
+    :param marks_mnc: if given, also write a mask of changed voxels
+    :param memory: budget in bytes for processing the volume in slabs
+    """
+    outputs = [(output_mnc, np.uint8)]
+    if marks_mnc:
+        outputs.append((marks_mnc, np.uint8))
+
+    def function(labels):
+        patched, marks = repair_subplate(labels)
+        return patched, marks.astype(np.uint8)
+
+    stream([(input_mnc, np.uint8)], outputs, function,
+           halo=1, memory=memory, bytes_per_voxel=8)
@@ -1,7 +1,30 @@
 import subprocess as sp
-from os import mkdir, path
-from tempfile import gettempdir
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import mkdir, makedirs, path, environ
+from tempfile import mkdtemp
 from glob import glob
+import numpy as np
+import pkg_resources
+from .cache import ResultCache, cache_key, hash_file
+from .minc import MincHeader
+from .repair import repair_subplate, repair_subplate_file
+from .slabs import parse_size, threshold_volume, stream
+
+
+__version__ = pkg_resources.require('surfaces_fetus')[0].version
+# version of the CIVET base image, see Dockerfile
+CIVET_VERSION = environ.get('CIVET_VERSION', 'unknown')
+
+# names of files in the intermediate directory
+WM_MASK = 'wm_mask.mnc'
+IZ_MASK = 'iz_mask.mnc'
+HEMISPHERE_LABELS = 'labels.mnc'
+
+# peak memory per voxel of split_hemispheres, measured with tracemalloc at
+# about 14 bytes for the slab as read and the outputs of both hemispheres,
+# with room for the halo of the repair and a hemisphere mask
+SPLIT_BYTES_PER_VOXEL = 24
 
 
 class UserError(Exception):
@@ -11,9 +34,9 @@ class UserError(Exception):
     pass
 
 
-def get_input_file(in_dir: str, g='*.mnc') -> str:
+def get_input_file(in_dir: str, g='*.mnc', exclude: str = None) -> str:
     loc = path.join(in_dir, g)
-    files = glob(loc)
+    files = [f for f in glob(loc) if path.basename(f) != exclude]
     if len(files) == 0:
         raise UserError(f'no input file - cannot find {loc}')
     elif len(files) > 1:
@@ -21,17 +44,120 @@ def get_input_file(in_dir: str, g='*.mnc') -> str:
     return files[0]
 
 
-def process(in_dir: str, out_dir: str, side: str, age: float, keep_intermediate: bool, qc: bool):
-    segmentation_mnc = get_input_file(in_dir)
+def process(in_dir: str, out_dir: str, side: str, age: float, keep_intermediate: bool, qc: bool,
+            repair: bool = False, max_memory: str = None,
+            cache_dir: str = None, cache_size: str = None,
+            midline: float = 0.0, hemisphere_mask: str = None):
     age = str(age)  # will get passed to subprocess.run
     side = side.lower()
-    if side not in ('left', 'right'):
-        raise ValueError('"--side" must be either "left" or "right"')
+    if side not in ('left', 'right', 'both'):
+        raise ValueError('"--side" must be either "left", "right" or "both"')
+    if side != 'both':
+        if hemisphere_mask:
+            raise UserError('"--hemisphere-mask" can only be used with "--side both"')
+        if midline:
+            raise UserError('"--midline" can only be used with "--side both"')
+    elif hemisphere_mask and midline:
+        raise UserError('"--midline" and "--hemisphere-mask" cannot be used together')
+    segmentation_mnc = get_input_file(in_dir, exclude=hemisphere_mask)
+    hemisphere_mnc = None
+    if hemisphere_mask:
+        hemisphere_mnc = path.join(in_dir, hemisphere_mask)
+        if not path.isfile(hemisphere_mnc):
+            raise UserError(f'hemisphere mask {hemisphere_mnc} does not exist')
+    try:
+        memory = parse_size(max_memory) if max_memory else None
+    except ValueError as e:
+        raise UserError(f'"--max-memory": {e}')
+
+    cache = None
+    input_key = None
+    civet_opts = []
+    if cache_dir:
+        try:
+            cache_max_size = parse_size(cache_size) if cache_size else None
+        except ValueError as e:
+            raise UserError(f'"--cache-size": {e}')
+        cache = ResultCache(path.join(cache_dir, 'results'), cache_max_size)
+        # surface smoothing matrices are small and reused by every subject
+        smoothing_dir = path.join(cache_dir, 'smoothing')
+        makedirs(smoothing_dir, exist_ok=True)
+        civet_opts = ['-cache', smoothing_dir]
+        input_key = cache_key(hash_file(segmentation_mnc), repair, __version__, CIVET_VERSION)
+
+    if side != 'both':
+        intf, qcf = work_dirs(out_dir, keep_intermediate, qc)
+        prepared = False
+
+        def prepare() -> str:
+            """
+            Repair the segmentation and create masks, unless already done.
+            """
+            nonlocal segmentation_mnc, prepared
+            if prepared:
+                return segmentation_mnc
+            if repair:
+                repaired_mnc = path.join(intf, 'labels_repaired.mnc')
+                repair_marks_mnc = path.join(intf, 'repair_marks.mnc') if keep_intermediate else None
+                repair_subplate_file(segmentation_mnc, repaired_mnc, repair_marks_mnc, memory)
+                segmentation_mnc = repaired_mnc
+            for label, mask_name in ((3, WM_MASK), (4, IZ_MASK)):
+                threshold_volume(segmentation_mnc, path.join(intf, mask_name), label - 0.5, memory)
+            prepared = True
+            return segmentation_mnc
+
+        process_hemisphere(out_dir, intf, qcf, side, age, keep_intermediate, qc, prepare,
+                           memory, cache, input_key, civet_opts)
+        return
+
+    # Both hemispheres: decode the segmentation once, shared by both pipelines.
+    if cache:
+        hemisphere_hash = hash_file(hemisphere_mnc) if hemisphere_mnc else None
+        input_key = cache_key(input_key, 'both', midline, hemisphere_hash)
+    hemispheres = {}
+    for hemisphere in ('left', 'right'):
+        hemisphere_dir = path.join(out_dir, hemisphere)
+        mkdir(hemisphere_dir)
+        hemisphere_intf, hemisphere_qcf = work_dirs(hemisphere_dir, keep_intermediate, qc)
+        hemispheres[hemisphere] = (hemisphere_dir, hemisphere_intf, hemisphere_qcf)
+    lock = threading.Lock()
+    prepared = False
+    # the hemispheres run concurrently, so they share the budget, but the split runs alone
+    hemisphere_memory = memory // 2 if memory else None
+
+    def prepare_both() -> None:
+        nonlocal prepared
+        with lock:
+            if not prepared:
+                split_hemispheres(segmentation_mnc, [intf for _, intf, _ in hemispheres.values()],
+                                  repair, keep_intermediate, midline, hemisphere_mnc, memory)
+                prepared = True
+
+    def run(hemisphere: str):
+        hemisphere_dir, intf, qcf = hemispheres[hemisphere]
 
+        def prepare() -> str:
+            prepare_both()
+            return path.join(intf, HEMISPHERE_LABELS)
+
+        process_hemisphere(hemisphere_dir, intf, qcf, hemisphere, age, keep_intermediate, qc,
+                           prepare, hemisphere_memory, cache, input_key, civet_opts)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # result() raises any exception from either pipeline
+        for future in [pool.submit(run, hemisphere) for hemisphere in hemispheres]:
+            future.result()
+
+
+def work_dirs(out_dir: str, keep_intermediate: bool, qc: bool):
+    """
+    :return: directories for intermediate files and QC files
+    """
     # we don't care about cleanup nor using tempfile's more advanced methods
-    # because we assume this script is being run in a stateless container
-    intf = gettempdir()
-    qcf = gettempdir()
+    # because we assume this script is being run in a stateless container,
+    # but every hemisphere needs its own directory
+    intf = mkdtemp(prefix='surfaces_fetus-')
+    qcf = intf
 
     if keep_intermediate:
         intf = path.join(out_dir, 'intermediate')
@@ -40,17 +166,75 @@ def process(in_dir: str, out_dir: str, side: str, age: float, keep_intermediate:
     if qc:
         qcf = path.join(out_dir, 'qc')
         mkdir(qcf)
+    return intf, qcf
+
+
+def split_hemispheres(segmentation_mnc: str, intermediate_dirs: list, repair: bool,
+                      keep_marks: bool, midline: float, hemisphere_mnc: str = None,
+                      memory: int = None):
+    """
+    Read the segmentation once and write the labels and masks of the left
+    and right hemispheres into their intermediate directories.
+
+    Voxels are assigned to a hemisphere by the hemisphere mask if given
+    (1=left, 2=right), otherwise by their world x coordinate relative to the midline.
+    """
+    header = MincHeader(segmentation_mnc)
+    keep_marks = keep_marks and repair
+    outputs = []
+    for intf in intermediate_dirs:
+        names = [HEMISPHERE_LABELS, WM_MASK, IZ_MASK]
+        if keep_marks:
+            names.append('repair_marks.mnc')
+        outputs += [(path.join(intf, name), np.uint8) for name in names]
+    inputs = [(segmentation_mnc, np.uint8)]
+    if hemisphere_mnc:
+        inputs.append((hemisphere_mnc, np.uint8))
+
+    def function(labels, hemisphere=None, z_start=0):
+        if repair:
+            labels, marks = repair_subplate(labels)
+        if hemisphere is None:
+            z_term, plane = header.world_coordinate(0, z_start, len(labels))
+            left = plane < midline - z_term
+            sides = (left, ~left)
+        else:
+            sides = (hemisphere == 1, hemisphere == 2)
+        results = []
+        for in_side in sides:
+            side_labels = labels * in_side
+            results += [side_labels, (side_labels > 2).view(np.uint8),
+                        (side_labels > 3).view(np.uint8)]
+            if keep_marks:
+                results.append((marks & in_side).view(np.uint8))
+        return tuple(results)
+
+    stream(inputs, outputs, function, halo=1 if repair else 0, memory=memory,
+           bytes_per_voxel=SPLIT_BYTES_PER_VOXEL, pass_z_start=True)
+
+
+def process_hemisphere(out_dir: str, intf: str, qcf: str, side: str, age: str,
+                       keep_intermediate: bool, qc: bool, prepare, memory: int = None,
+                       cache: ResultCache = None, input_key: str = None, civet_opts=()):
+    """
+    Extract the surfaces of one brain hemisphere.
+
+    :param prepare: creates the masks in intf before the first stage which is not
+                    cached, returns the (possibly repaired) segmentation
+    """
+    memory_opts = ['-memory', str(memory)] if memory else []
+    segmentation_mnc = None
 
     layer3_obj = path.join(out_dir, 'wm_81920.obj')
     layer3_log = path.join(qcf, 'wm_cubes.log')
-    layer3_mask_mnc = path.join(intf, 'wm_mask.mnc')
+    layer3_mask_mnc = path.join(intf, WM_MASK)
     layer3_chamfer_mnc = path.join(intf, 'wm_chamfer.mnc')
     layer3_dist_txt = path.join(qcf, 'wm_dist.txt')
     layer3_smth_txt = path.join(qcf, 'wm_smth.txt')
     layer3_area_txt = path.join(qcf, 'wm_area.txt')
     layer4_obj = path.join(out_dir, 'iz_81920.obj')
     layer4_log = path.join(qcf, 'iz_fit.log')
-    layer4_mask_mnc = path.join(intf, 'iz_mask.mnc')
+    layer4_mask_mnc = path.join(intf, IZ_MASK)
     layer4_chamfer_mnc = path.join(intf, 'iz_chamfer.mnc')
     layer4_dist_txt = path.join(qcf, 'iz_dist.txt')
     layer4_smth_txt = path.join(qcf, 'iz_smth.txt')
@@ -62,50 +246,78 @@ def process(in_dir: str, out_dir: str, side: str, age: float, keep_intermediate:
     mid_surface = path.join(intf, 'mid_81920.obj')
     vertexmask = path.join(qcf, 'not_subplate_mask.txt')
 
-    def minccalc_mask(label: int, mask_fname: str):
-        """
-        Create a binary mask for a given label number from the painted labels volume.
-        :param label: desired label
-        :param mask_fname: mask file prefix
-        """
-        sp.run(['minccalc', '-quiet', '-clobber', '-byte', '-unsigned', '-expr',
-                f'A[0]>{label - 0.5}', segmentation_mnc, mask_fname], check=True)
+    highlight_mnc = path.join(intf, 'highlight_uncovered_subplate.mnc')
+
+    # outputs of every stage, by their names in the cache
+    wm_outputs = {'wm_81920.obj': layer3_obj, 'wm_cubes.log': layer3_log}
+    iz_outputs = {'iz_81920.obj': layer4_obj, 'iz_fit.log': layer4_log,
+                  'sp_thickness_tlink.txt': thickness_tlink}
+    qc_outputs = {path.basename(f): f for f in (
+        layer3_chamfer_mnc, layer3_dist_txt, layer3_smth_txt, layer3_area_txt,
+        layer4_chamfer_mnc, layer4_dist_txt, layer4_smth_txt, layer4_area_txt,
+        thickness_tnear, tlink_minus_tnear, angles_txt, mid_surface,
+        highlight_mnc, vertexmask
+    )}
+
+    if cache:
+        # the result of each stage is determined by the results of the stages before it
+        wm_key = cache_key(input_key, 'wm', side, age)
+        iz_key = cache_key(wm_key, 'iz', age)
+        qc_key = cache_key(iz_key, 'qc')
+    else:
+        wm_key = iz_key = qc_key = None
 
     def surface_qc(surface, mask, chamfer, dist_txt, smth_txt, area_txt):
-        if not qc:
-            return
         sp.run(['chamfer.sh', '-c', '0.0', mask, chamfer], check=True)
         sp.run(['volume_object_evaluate', '-linear', chamfer, surface, dist_txt], check=True)
         sp.run(['smoothness.py', surface, smth_txt], check=True)
         sp.run(['depth_potential', '-area_simple', surface, area_txt], check=True)
 
     def run_log(*args, logfile_name=None, **kwargs):
-        if qc:
-            with open(logfile_name, 'w') as log_file:
-                sp.run(*args, **kwargs, stderr=sp.STDOUT, stdout=log_file)
-        else:
-            sp.run(*args, **kwargs, stderr=sp.STDOUT, stdout=sp.DEVNULL)
+        # logs are always written so that they can be cached,
+        # they only end up in the output directory if qc
+        with open(logfile_name, 'w') as log_file:
+            sp.run(*args, **kwargs, stderr=sp.STDOUT, stdout=log_file)
 
-    minccalc_mask(3, layer3_mask_mnc)
-    minccalc_mask(4, layer4_mask_mnc)
-    run_log(['marching_cubes_fetus.pl', f'-{side}', '-age', age,
-             layer3_mask_mnc, layer3_obj], check=True, logfile_name=layer3_log)
-    run_log(['fit_subplate.pl', '-age', age,
-             layer4_mask_mnc, layer3_obj, layer4_obj], check=True, logfile_name=layer4_log)
-    sp.run(['cortical_thickness', '-tlink', layer4_obj, layer3_obj, thickness_tlink], check=True)
+    def stage(key: str, outputs: dict, run):
+        """
+        Restore the outputs of a stage from the cache, or run it and cache its outputs.
+        """
+        nonlocal segmentation_mnc
+        if cache and cache.fetch(key, outputs):
+            return
+        segmentation_mnc = prepare()
+        run()
+        if cache:
+            cache.store(key, outputs)
 
-    if not qc:
-        return
+    def extract_wm():
+        run_log(['marching_cubes_fetus.pl', f'-{side}', '-age', age, *memory_opts, *civet_opts,
+                 layer3_mask_mnc, layer3_obj], check=True, logfile_name=layer3_log)
+
+    def fit_iz():
+        run_log(['fit_subplate.pl', '-age', age, *memory_opts,
+                 layer4_mask_mnc, layer3_obj, layer4_obj], check=True, logfile_name=layer4_log)
+        sp.run(['cortical_thickness', '-tlink', layer4_obj, layer3_obj, thickness_tlink], check=True)
+
+    def quality_check():
+        surface_qc(layer3_obj, layer3_mask_mnc, layer3_chamfer_mnc,
+                   layer3_dist_txt, layer3_smth_txt, layer3_area_txt)
+        surface_qc(layer4_obj, layer4_mask_mnc, layer4_chamfer_mnc,
+                   layer4_dist_txt, layer4_smth_txt, layer4_area_txt)
+        sp.run(['cortical_thickness', '-tlink',
+                layer3_obj, layer4_obj, thickness_tnear], check=True)
+        sp.run(['vertstats_math', '-old_style_file', '-sub',
+                thickness_tlink, thickness_tnear, tlink_minus_tnear], check=True)
+        sp.run(['distortion_angles.py', '-mid', mid_surface,
+                layer4_obj, layer3_obj, angles_txt], check=True)
+        sp.run(['diemesh.py', *memory_opts, '-keep', highlight_mnc,
+                '-boundary', "2", segmentation_mnc, layer3_obj, vertexmask], check=True)
 
-    surface_qc(layer3_obj, layer3_mask_mnc, layer3_chamfer_mnc,
-               layer3_dist_txt, layer3_smth_txt, layer3_area_txt)
-    surface_qc(layer4_obj, layer4_mask_mnc, layer4_chamfer_mnc,
-               layer4_dist_txt, layer4_smth_txt, layer4_area_txt)
-    sp.run(['cortical_thickness', '-tlink',
-            layer3_obj, layer4_obj, thickness_tnear], check=True)
-    sp.run(['vertstats_math', '-old_style_file', '-sub',
-            thickness_tlink, thickness_tnear, tlink_minus_tnear], check=True)
-    sp.run(['distortion_angles.py', '-mid', mid_surface,
-            layer4_obj, layer3_obj, angles_txt], check=True)
-    sp.run(['diemesh.py', '-keep', path.join(intf, 'highlight_uncovered_subplate.mnc'),
-            '-boundary', "2", segmentation_mnc, layer3_obj, vertexmask], check=True)
+    stage(wm_key, wm_outputs, extract_wm)
+    stage(iz_key, iz_outputs, fit_iz)
+    if qc:
+        stage(qc_key, qc_outputs, quality_check)
+    if keep_intermediate:
+        # masks are intermediate outputs too, even if every stage was cached
+        prepare()
@@ -0,0 +1,186 @@
+"""
+Volume processing over z-slabs, so that peak memory is bounded
+by a budget instead of by the size of the volume.
+
+Each slab is read from disk together with a halo of neighbouring slices
+which is at least as deep as the reach of the operation, so the result
+over the core of the slab is identical to processing the whole volume.
+"""
+
+import re
+from contextlib import ExitStack
+from math import ceil
+
+import numpy as np
+from scipy import ndimage
+
+from .minc import MincHeader, VolumeWriter, read_hyperslab
+
+
+SIX_CONNECTED = ndimage.generate_binary_structure(3, 1)
+TWENTY_SIX_CONNECTED = ndimage.generate_binary_structure(3, 3)
+
+# rough upper bound of working memory per voxel for the operations below
+DEFAULT_BYTES_PER_VOXEL = 32
+# peak measured with tracemalloc for chamfer() of a slab read as float32:
+# the distance transform alone needs about 49 bytes per voxel
+CHAMFER_BYTES_PER_VOXEL = 64
+
+_SIZE_UNITS = {
+    '': 1,
+    'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3,
+    'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3,
+}
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size in bytes, with the same suffixes as MAX_MEMORY_LIMIT, e.g. '512Mi' or '2Gi'.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]i?)?\s*', str(size))
+    if not match:
+        raise ValueError(f'not a valid size: "{size}"')
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit or ''])
+
+
+def slab_depth(header: MincHeader, halo: int, memory: int = None,
+               bytes_per_voxel=DEFAULT_BYTES_PER_VOXEL) -> int:
+    """
+    :param memory: budget in bytes, or None for the whole volume in one slab
+    :return: number of z-slices per slab, not counting the halo
+    :raises ValueError: if the budget cannot hold a slab of one slice and its halo
+    """
+    nz, ny, nx = header.shape
+    if memory is None:
+        return nz
+    plane_bytes = ny * nx * bytes_per_voxel
+    planes = memory // plane_bytes
+    if planes >= nz:
+        return nz
+    if planes < 1 + 2 * halo:
+        minimum = min(nz, 1 + 2 * halo) * plane_bytes
+        raise ValueError(f'memory budget of {memory} bytes is too small, slabs of this '
+                         f'volume need at least {minimum} bytes ({ceil(minimum / 1024 ** 2)}Mi)')
+    return int(planes - 2 * halo)
+
+
+def stream(inputs: list, outputs: list, function, halo=0, memory: int = None,
+           bytes_per_voxel=DEFAULT_BYTES_PER_VOXEL, pass_z_start=False):
+    """
+    Apply a function over corresponding z-slabs of volumes of the same shape.
+
+    :param inputs: list of (filename, dtype) of input volumes
+    :param outputs: list of (filename, dtype) of output volumes,
+                    their spatial information is copied from the first input
+    :param function: given one slab per input, returns one array (or a tuple
+                     of arrays, one per output) of the same shape as its inputs
+    :param halo: number of extra slices needed on each side of a slab
+    :param memory: budget in bytes, or None to process the whole volume at once
+    :param bytes_per_voxel: working memory needed by function per voxel
+    :param pass_z_start: also give function the index of the first slice of the slabs
+                         as the keyword argument z_start
+    """
+    headers = [MincHeader(filename) for filename, _ in inputs]
+    header = headers[0]
+    for (filename, _), other in zip(inputs[1:], headers[1:]):
+        if other.shape != header.shape:
+            raise ValueError(f'{filename} has shape {other.shape} but '
+                             f'{inputs[0][0]} has shape {header.shape}')
+    nz = header.shape[0]
+    depth = slab_depth(header, halo, memory, bytes_per_voxel)
+
+    with ExitStack() as stack:
+        writers = [stack.enter_context(VolumeWriter(filename, header, dtype))
+                   for filename, dtype in outputs]
+        for z_start in range(0, nz, depth):
+            z_end = min(nz, z_start + depth)
+            lower = max(0, z_start - halo)
+            upper = min(nz, z_end + halo)
+            slabs = [read_hyperslab(filename, h, dtype, lower, upper - lower)
+                     for (filename, dtype), h in zip(inputs, headers)]
+            kwargs = {'z_start': lower} if pass_z_start else {}
+            results = function(*slabs, **kwargs)
+            if not isinstance(results, tuple):
+                results = (results,)
+            for writer, result in zip(writers, results):
+                writer.write(result[z_start - lower:z_end - lower])
+
+
+def count_neighbours(mask: np.ndarray) -> np.ndarray:
+    """
+    Number of 6-connected neighbours of every voxel which are in the mask,
+    equivalent to mincmorph -convolve with the ngh_count kernel.
+    """
+    mask = mask.astype(np.uint8)
+    count = np.zeros(mask.shape, dtype=np.uint8)
+    for axis in range(3):
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        count[tuple(lo)] += mask[tuple(hi)]
+        count[tuple(hi)] += mask[tuple(lo)]
+    return count
+
+
+def clean_mask(mask: np.ndarray, iterations=5, lower=2.5, upper=4.5) -> np.ndarray:
+    """
+    Remove loosely connected voxels and fill-in tightly connected voxels,
+    as done by marching_cubes_fetus.pl before running marching-cubes.
+    """
+    mask = mask.astype(bool)
+    for _ in range(iterations):
+        count = count_neighbours(mask)
+        mask = (count > upper) | (mask & (count >= lower))
+    return mask
+
+
+def chamfer(mask: np.ndarray, sampling, max_outside: float, max_inside: float,
+            iso=10.0, slope=1.0) -> np.ndarray:
+    """
+    Signed distance map around the boundary of a mask in mm,
+    equivalent to combining mincchamfer of the mask and of its negation:
+
+        iso + (outside - inside) * slope
+
+    where outside and inside are the distances to the mask from voxels outside
+    the mask and to the background from voxels inside, clipped at a maximum.
+    """
+    mask = mask.astype(bool)
+    outside = _clipped_distance(~mask, sampling, max_outside)
+    inside = _clipped_distance(mask, sampling, max_inside)
+    return (iso + (outside - inside) * slope).astype(np.float32)
+
+
+def _clipped_distance(region: np.ndarray, sampling, max_dist: float) -> np.ndarray:
+    if region.all():
+        return np.full(region.shape, max_dist, dtype=np.float32)
+    distance = ndimage.distance_transform_edt(region, sampling=sampling)
+    return np.minimum(distance, max_dist).astype(np.float32)
+
+
+def threshold_volume(input_mnc: str, output_mnc: str, lower: float, memory: int = None):
+    """
+    Binary mask of voxels greater than lower, like minccalc -expr 'A[0]>lower'.
+    """
+    stream([(input_mnc, np.float32)], [(output_mnc, np.uint8)],
+           lambda data: (data > lower).astype(np.uint8),
+           memory=memory, bytes_per_voxel=6)
+
+
+def clean_mask_volume(input_mnc: str, output_mnc: str, iterations=5, memory: int = None):
+    stream([(input_mnc, np.uint8)], [(output_mnc, np.uint8)],
+           lambda data: clean_mask(data > 0.5, iterations).astype(np.uint8),
+           halo=iterations, memory=memory, bytes_per_voxel=4)
+
+
+def chamfer_volume(input_mnc: str, output_mnc: str, max_outside: float, max_inside: float,
+                   iso=10.0, slope=1.0, memory: int = None):
+    header = MincHeader(input_mnc)
+    # voxel separation in mm can be negative
+    sampling = [abs(header.step[dim]) for dim in ('zspace', 'yspace', 'xspace')]
+    halo = int(ceil(max(max_outside, max_inside) / sampling[0])) + 1
+    stream([(input_mnc, np.float32)], [(output_mnc, np.float32)],
+           lambda data: chamfer(data > 0.5, sampling, max_outside, max_inside, iso, slope),
+           halo=halo, memory=memory, bytes_per_voxel=CHAMFER_BYTES_PER_VOXEL)
@@ -0,0 +1,127 @@
+"""
+Sphere-to-sphere interpolation, the in-process equivalent of interpolate_sphere.
+
+Point location on the source sphere is done through a KD-tree over
+the triangle centroids, which is built once and then reused for
+interpolating any number of target spheres.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def _normalize(points: np.ndarray) -> np.ndarray:
+    points = np.asarray(points, dtype=np.float64)
+    return points / np.linalg.norm(points, axis=-1, keepdims=True)
+
+
+class SphereLocator:
+    """
+    Locates points of a unit sphere on the triangles of a source sphere.
+
+    Attributes:
+        points: (n_points, 3) vertices of the source sphere, projected onto the unit sphere
+        triangles: (n_triangles, 3) connectivity of the source sphere
+    """
+    def __init__(self, points: np.ndarray, triangles: np.ndarray, k=8, batch_size=65536):
+        """
+        :param points: vertices of the source sphere
+        :param triangles: connectivity of the source sphere
+        :param k: number of nearby triangles to consider for each target point at first
+        :param batch_size: number of target points to locate at a time
+        """
+        self.points = _normalize(points)
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        self.k = min(k, len(self.triangles))
+        self.batch_size = batch_size
+        corners = self.points[self.triangles]
+        self._origin = corners[:, 0]
+        self._edge1 = corners[:, 1] - corners[:, 0]
+        self._edge2 = corners[:, 2] - corners[:, 0]
+        self._tree = cKDTree(_normalize(corners.mean(axis=1)))
+
+    def locate(self, targets: np.ndarray, eps=1e-9):
+        """
+        Find the triangle of the source sphere which every target point
+        radially projects onto.
+
+        :param targets: (n, 3) points on the target sphere
+        :return: tuple of (triangle indices of shape (n,),
+                 barycentric weights of shape (n, 3))
+        """
+        targets = _normalize(targets)
+        n = len(targets)
+        found = np.empty(n, dtype=np.int64)
+        weights = np.empty((n, 3), dtype=np.float64)
+        for start in range(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            found[start:end], weights[start:end] = self._locate_batch(targets[start:end], eps)
+        return found, weights
+
+    def _locate_batch(self, targets: np.ndarray, eps: float):
+        n = len(targets)
+        found = np.zeros(n, dtype=np.int64)
+        weights = np.zeros((n, 3), dtype=np.float64)
+        score = np.full(n, -np.inf)
+        unresolved = np.arange(n)
+        k = self.k
+        while len(unresolved):
+            k = min(k, len(self.triangles))
+            _, candidates = self._tree.query(targets[unresolved], k=max(k, 2))
+            w = self._barycentric(targets[unresolved], candidates)
+            w_min = w.min(axis=2)
+            best = np.argmax(w_min, axis=1)
+            rows = np.arange(len(unresolved))
+            improved = w_min[rows, best] > score[unresolved]
+            update = unresolved[improved]
+            found[update] = candidates[rows, best][improved]
+            weights[update] = w[rows, best][improved]
+            score[update] = w_min[rows, best][improved]
+
+            if k == len(self.triangles):
+                break
+            # skinny triangles can be far from their centroids,
+            # widen the search for points which were not contained
+            unresolved = unresolved[score[unresolved] < -eps]
+            k *= 4
+
+        # numerical edge cases: snap onto the closest triangle
+        weights = np.clip(weights, 0, None)
+        weights /= weights.sum(axis=1, keepdims=True)
+        return found, weights
+
+    def _barycentric(self, targets: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """
+        Moller-Trumbore intersection of the ray from the center of the sphere
+        through each target point with each of its candidate triangles.
+
+        :return: barycentric weights of shape (n, k, 3), -inf for triangles
+                 which are behind the origin or parallel to the ray
+        """
+        direction = targets[:, np.newaxis, :]
+        edge1 = self._edge1[candidates]
+        edge2 = self._edge2[candidates]
+        tvec = -self._origin[candidates]
+        pvec = np.cross(direction, edge2)
+        det = np.einsum('nkj,nkj->nk', edge1, pvec)
+        valid = np.abs(det) > 1e-15
+        det[~valid] = 1
+        u = np.einsum('nkj,nkj->nk', tvec, pvec) / det
+        qvec = np.cross(tvec, edge1)
+        v = np.einsum('nkj,nkj->nk', direction, qvec) / det
+        t = np.einsum('nkj,nkj->nk', edge2, qvec) / det
+        w = np.stack((1 - u - v, u, v), axis=2)
+        w[~valid | (t <= 0)] = -np.inf
+        return w
+
+    def interpolate(self, values: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """
+        Interpolate per-vertex values of the source sphere, e.g. the coordinates
+        of the surface which the source sphere was inflated from, at target points.
+
+        :param values: array of shape (n_points, ...) over the source sphere
+        :param targets: (n, 3) points on the target sphere
+        """
+        found, weights = self.locate(targets)
+        corners = np.asarray(values)[self.triangles[found]]
+        return np.einsum('nk,nk...->n...', weights, corners)
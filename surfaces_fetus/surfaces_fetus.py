@@ -35,7 +35,7 @@ Gstr_synopsis = """
         
     USAGE
     
-        python3 -m surfaces_fetus --age <n.n> --side [left|right] <inputDir> <outputDir>
+        python3 -m surfaces_fetus --age <n.n> --side [left|right|both] <inputDir> <outputDir>
 
         The input directory should contain a single .mnc file, which is the
         painted labels i.e. segmented volume of a single brain hemisphere (left or right)
@@ -45,7 +45,9 @@ Gstr_synopsis = """
             4=intermediate zone
         
         The script has two required arguments: --age (in gestational weeks)
-        and --side (left or right brain hemisphere).
+        and --side (left or right brain hemisphere). With --side both, the volume
+        contains both hemispheres and the surfaces of each are written to the
+        left/ and right/ subdirectories of the output directory.
     
     EXAMPLE
     
@@ -133,18 +135,34 @@ class SurfacesFetusWrapper(ChrisApp):
         self.add_argument('--age', dest='age', type=float, optional=False,
                           help='gestational age estimate in weeks')
         self.add_argument('--side', dest='side', type=str, optional=False,
-                          help='brain hemisphere [left, right]')
+                          help='brain hemisphere [left, right, both]')
         self.add_argument('--keep-intermediate', dest='keep', type=bool, default=False, optional=True,
                           help='keep intermediate files (e.g. *mask.mnc, *chanfer.mnc)')
         self.add_argument('--qc', dest='qc', type=bool, default=False, optional=True,
                           help='save surface_fit logs and produce vertex-wise quality check files')
+        self.add_argument('--repair-subplate', dest='repair', type=bool, default=False, optional=True,
+                          help='patch discontinuous subplate in the segmentation before extraction')
+        self.add_argument('--max-memory', dest='max_memory', type=str, default='', optional=True,
+                          help='memory budget for volume processing, e.g. 512Mi or 2Gi '
+                               '(default: whole volumes at once)')
+        self.add_argument('--cache-dir', dest='cache_dir', type=str, default='', optional=True,
+                          help='directory for reusing results of previous runs on identical inputs')
+        self.add_argument('--cache-size', dest='cache_size', type=str, default='10Gi', optional=True,
+                          help='size of --cache-dir above which least recently used results are removed')
+        self.add_argument('--midline', dest='midline', type=float, default=0.0, optional=True,
+                          help='with --side both, world x coordinate which separates the hemispheres')
+        self.add_argument('--hemisphere-mask', dest='hemisphere_mask', type=str, default='', optional=True,
+                          help='with --side both, name of a volume in the input directory labelling '
+                               'the left (1) and right (2) hemispheres, instead of --midline')
 
     def run(self, options):
         """
         Define the code to be run by this plugin app.
         """
         try:
-            process(options.inputdir, options.outputdir, options.side, options.age, options.keep, options.qc)
+            process(options.inputdir, options.outputdir, options.side, options.age, options.keep, options.qc,
+                    options.repair, options.max_memory, options.cache_dir, options.cache_size,
+                    options.midline, options.hemisphere_mask)
         except UserError as e:
             print(e.message)
 
@@ -0,0 +1,30 @@
+import shutil
+import subprocess as sp
+
+import numpy as np
+import pytest
+
+from surfaces_fetus.minc import read_volume, read_hyperslab
+
+
+pytestmark = pytest.mark.skipif(shutil.which('rawtominc') is None,
+                                reason='MINC tools are not installed')
+
+
+def test_scaled_byte_labels(tmp_path):
+    """
+    Labels stored as bytes scaled to a real range are read as their real values.
+    """
+    labels = np.random.default_rng(0).integers(0, 5, (6, 5, 4), dtype=np.uint8)
+    filename = str(tmp_path / 'labels.mnc')
+    # voxel value v is the real value 4 * v / 204, i.e. label * 51 is the label
+    sp.run(['rawtominc', '-clobber', '-transverse', '-byte', '-unsigned',
+            '-range', '0', '204', '-real_range', '0', '4', filename, *map(str, labels.shape)],
+           input=(labels * 51).tobytes(), check=True)
+
+    data, header = read_volume(filename, np.uint8)
+    assert header.shape == labels.shape
+    np.testing.assert_array_equal(data, labels)
+    real, _ = read_volume(filename, np.float32, header)
+    np.testing.assert_allclose(real, labels, atol=1e-3)
+    np.testing.assert_array_equal(read_hyperslab(filename, header, np.uint8, 2, 3), labels[2:5])